@@ -3,15 +3,30 @@
 # render with bpmn-js, and manage KPIs (CSV). Optional: use OpenAI to
 # propose KPIs and download a ready CSV to commit back to the repo.
 
+import base64
+import hashlib
 import io
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 
 import pandas as pd
 import requests
 import streamlit as st
-from xml.etree import ElementTree as ET
+from requests.adapters import HTTPAdapter
+from streamlit_autorefresh import st_autorefresh
+from urllib3.util.retry import Retry
+
+try:
+    # libxml2-backed parser; noticeably faster than the stdlib on big diagrams
+    from lxml import etree as ET
+    _ITERPARSE_OPTS = {"remove_blank_text": True, "huge_tree": False}
+    _HAS_LXML = True
+except ImportError:  # fall back to the stdlib so the app still runs without lxml
+    from xml.etree import ElementTree as ET
+    _ITERPARSE_OPTS = {}
+    _HAS_LXML = False
 
 # ------------------ PAGE SETUP ------------------
 st.set_page_config(page_title="BPMN + KPI Dashboard", page_icon="🧭", layout="wide")
@@ -37,9 +52,6 @@ BRANCH = "main"                       # "main" unless you use another branch
 # Private repo? Set True and put GITHUB_TOKEN in Streamlit Secrets
 USE_GITHUB_TOKEN = True
 
-# Default list of folders to show if dynamic listing fails (optional)
-DEFAULT_FOLDERS = ["hr", "finance", "claims"]
-
 # Auto-refresh seconds (0 = off)
 AUTO_REFRESH_SECONDS = st.sidebar.number_input(
     "Auto-refresh (seconds, 0=off)", min_value=0, max_value=600, value=0, step=5
@@ -55,122 +67,277 @@ def _auth_headers_json():
             h["Authorization"] = f"Bearer {tok}"
     return h
 
-def gh_contents(path=""):
+@st.cache_resource(show_spinner=False)
+def _session() -> requests.Session:
+    """
+    Shared keep-alive session so (concurrent) GETs reuse pooled connections
+    to api.github.com / raw.githubusercontent.com. Transient 5xx responses are
+    retried with a short backoff. Auth headers are deliberately not stored on
+    the session: they're passed per request so a rotated GITHUB_TOKEN applies
+    without a restart.
+    """
+    s = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return s
+
+def _gh_contents(path=""):
     """
     List files/folders in a path using GitHub Contents API.
     Returns list[dict] with keys: name, path, type ('file'|'dir'), download_url, etc.
     """
     api = f"https://api.github.com/repos/{REPO_USER}/{REPO_NAME}/contents/{path}?ref={quote(BRANCH)}"
-    r = requests.get(api, headers=_auth_headers_json(), timeout=20)
+    r = _session().get(api, headers=_auth_headers_json(), timeout=20)
     r.raise_for_status()
     return r.json()
 
-def list_folders_at_root():
-    """Return directory names at repo root (fallback to DEFAULT_FOLDERS on error)."""
-    try:
-        items = gh_contents("")  # root
-        return [it["name"] for it in items if it.get("type") == "dir"]
-    except Exception:
-        return DEFAULT_FOLDERS
+@st.cache_data(ttl=300, show_spinner=False)
+def repo_layout() -> dict:
+    """
+    Map each root folder to the .bpmn files directly inside it, using a single
+    recursive Git Trees API call for the whole branch.
+    Returns dict {folder: [bpmn_file_name, ...]}.
+    """
+    api = f"https://api.github.com/repos/{REPO_USER}/{REPO_NAME}/git/trees/{quote(BRANCH)}?recursive=1"
+    r = _session().get(api, headers=_auth_headers_json(), timeout=20)
+    r.raise_for_status()
+    tree = r.json()
+    if tree.get("truncated"):
+        # recursive listing hit GitHub's size limit: entries may be missing, so
+        # fall back to listing each root folder with the Contents API
+        return {
+            it["name"]: [
+                f["name"] for f in _gh_contents(it["path"])
+                if f.get("type") == "file" and f["name"].lower().endswith(".bpmn")
+            ]
+            for it in _gh_contents("")
+            if it.get("type") == "dir"
+        }
+    layout = {}
+    for it in tree.get("tree", []):
+        parts = it["path"].split("/")
+        if it.get("type") == "tree" and len(parts) == 1:
+            layout.setdefault(parts[0], [])
+        elif it.get("type") == "blob" and len(parts) == 2 and parts[1].lower().endswith(".bpmn"):
+            layout.setdefault(parts[0], []).append(parts[1])
+    return layout
 
 def raw_url(path):
     return f"https://raw.githubusercontent.com/{REPO_USER}/{REPO_NAME}/{BRANCH}/{path}"
 
-def head_exists(url):
-    r = requests.head(url, headers=_auth_headers_json(), timeout=15)
-    return r.status_code == 200
-
 # ------------------ LOADERS (CACHED) ------------------
-@st.cache_data(ttl=60)
-def load_text(url: str) -> str:
-    r = requests.get(url, headers=_auth_headers_json(), timeout=20)
-    r.raise_for_status()
-    return r.text
+# Downloaded bodies are kept for the life of the process; within this window
+# they are served as-is, after it they are revalidated with a conditional GET.
+REVALIDATE_SECONDS = 60
+
+@st.cache_resource(show_spinner=False)
+def _http_cache() -> dict:
+    """Process-wide {url: (etag, last_modified, body, checked_at)} store for conditional GETs."""
+    return {}
+
+def _expire_http_cache():
+    """Force revalidation of every stored body on its next use (bodies are kept)."""
+    cache = _http_cache()
+    for url, (etag, last_modified, body, _) in list(cache.items()):
+        cache[url] = (etag, last_modified, body, 0.0)
+
+def _not_found(url: str) -> requests.HTTPError:
+    """HTTPError equivalent to a raise_for_status() on a 404 for url."""
+    resp = requests.Response()
+    resp.status_code, resp.reason, resp.url = 404, "Not Found", url
+    return requests.HTTPError(f"404 Client Error: Not Found for url: {url}", response=resp)
+
+def _conditional_get(url: str) -> bytes:
+    """
+    Return the body of url, hitting the network at most once per
+    REVALIDATE_SECONDS. Revalidation sends If-None-Match / If-Modified-Since
+    from the previous response; on 304 Not Modified the stored body is reused,
+    so unchanged files cost a header round trip instead of a full download.
+    A 404 is remembered too (body None) and re-raised inside the window, so
+    absent files (e.g. a diagram without KPI CSV) aren't re-requested per rerun.
+    If revalidation fails for any reason other than 404, the stored body is
+    served (stale) rather than failing the page.
+    """
+    cache = _http_cache()
+    cached = cache.get(url)
+    now = time.monotonic()
+    headers = _auth_headers_json()
+    if cached:
+        etag, last_modified, body, checked_at = cached
+        if now - checked_at < REVALIDATE_SECONDS:
+            if body is None:
+                raise _not_found(url)
+            return body
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    try:
+        r = _session().get(url, headers=headers, timeout=20)
+        if r.status_code == 304 and cached:
+            cache[url] = (etag, last_modified, body, now)
+            return body
+        r.raise_for_status()
+    except requests.RequestException as e:
+        resp = getattr(e, "response", None)
+        if resp is not None and resp.status_code == 404:
+            cache[url] = (None, None, None, now)
+            raise
+        # cache fallback: if revalidation fails (timeout, 5xx, rate limit) keep
+        # serving the stored copy (or stored absence) for another window
+        if not cached:
+            raise
+        cache[url] = (etag, last_modified, body, now)
+        if body is None:
+            raise _not_found(url)
+        return body
+    # keep the raw bytes: the XML parser and base64 both want bytes, so
+    # decoding to str here would only be re-encoded again downstream
+    cache[url] = (r.headers.get("ETag"), r.headers.get("Last-Modified"), r.content, now)
+    return r.content
+
+def load_bytes(url: str) -> bytes:
+    return _conditional_get(url)
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def _parse_csv(data: bytes) -> pd.DataFrame:
+    """Memoised on the CSV bytes, so an unchanged (304) download is never re-parsed."""
+    return pd.read_csv(io.BytesIO(data))
 
-@st.cache_data(ttl=60)
 def load_csv_safe(url: str) -> pd.DataFrame:
-    r = requests.get(url, headers=_auth_headers_json(), timeout=20)
-    r.raise_for_status()
-    return pd.read_csv(io.StringIO(r.text))
+    return _parse_csv(_conditional_get(url))
 
 # ------------------ BPMN PARSER ------------------
-def parse_kpi_properties(bpmn_xml: str) -> pd.DataFrame:
+# Tags/attributes pre-expanded to Clark notation ({uri}local), the form the
+# parser stores them in, so no namespace-prefix resolution happens per match
+_BPMN = "{http://www.omg.org/spec/BPMN/20100524/MODEL}"
+_PROCESS_TAG = _BPMN + "process"
+_NAME_ATTR_EXPANDED = _BPMN + "name"
+_CAMUNDA_PROP = "{http://camunda.org/schema/1.0/bpmn}property"
+_KPI_COLUMNS = ("element_id", "element_name", "kpi_key", "kpi_target", "owner")
+
+def bpmn_digest(bpmn_xml: bytes) -> str:
+    """Content hash used as the cache key for everything derived from the XML."""
+    return hashlib.sha256(bpmn_xml).hexdigest()
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def parse_bpmn(xml_digest: str, _bpmn_xml: bytes) -> tuple[pd.DataFrame, list[str]]:
     """
-    Extract camunda:properties (kpi_key, kpi_target, owner) from BPMN elements.
+    Single pass over the BPMN process elements. Returns:
+      - DataFrame of camunda:properties (kpi_key, kpi_target, owner) per element
+      - all element names (tasks/events/gateways with a name), deduped
+    Cached on xml_digest; the leading underscore stops Streamlit from hashing
+    the (possibly multi-MB) XML itself on every rerun.
     """
-    ns = {
-        "bpmn": "http://www.omg.org/spec/BPMN/20100524/MODEL",
-        "bpmndi": "http://www.omg.org/spec/BPMN/20100524/DI",
-        "dc": "http://www.omg.org/spec/DD/20100524/DC",
-        "di": "http://www.omg.org/spec/DD/20100524/DI",
-        "camunda": "http://camunda.org/schema/1.0/bpmn",
-    }
-    root = ET.fromstring(bpmn_xml.encode("utf-8"))
-    rows = []
-    for el in root.findall(".//bpmn:process//*[@id]", ns):
-        el_id = el.attrib.get("id", "")
-        # name may be in default ns or explicitly prefixed; cover both
-        el_name = el.attrib.get("name") or el.attrib.get(
-            "{http://www.omg.org/spec/BPMN/20100524/MODEL}name", ""
-        )
-        props = {}
-        for p in el.findall(".//camunda:property", ns):
-            props[p.attrib.get("name", "")] = p.attrib.get("value", "")
-        if props:
-            rows.append(
-                {
-                    "element_id": el_id,
-                    "element_name": el_name,
-                    "kpi_key": props.get("kpi_key", ""),
-                    "kpi_target": props.get("kpi_target", ""),
-                    "owner": props.get("owner", ""),
-                }
-            )
-    return pd.DataFrame(rows)
-
-def extract_named_tasks(bpmn_xml: str) -> list:
-    """Get all element names (tasks/events/gateways with a name), deduped."""
-    ns = {"bpmn": "http://www.omg.org/spec/BPMN/20100524/MODEL"}
-    root = ET.fromstring(bpmn_xml.encode("utf-8"))
+    # Stream the document instead of building a full tree: each element is
+    # cleared once closed and, with lxml, detached along with its processed
+    # siblings, so the tree never holds more than the open path. (The stdlib
+    # fallback can only clear, leaving one empty element per node until the end.)
+    # Processes are direct children of <definitions>; everything else at that
+    # level (notably the bpmndi:* diagram section) is only skimmed past.
+    events = ET.iterparse(io.BytesIO(_bpmn_xml), events=("start", "end"), **_ITERPARSE_OPTS)
     names = []
-    for el in root.findall(".//bpmn:process//*[@id]", ns):
-        nm = el.attrib.get("name") or el.attrib.get(
-            "{http://www.omg.org/spec/BPMN/20100524/MODEL}name"
+    tagged = []  # (el_id, el_name, props) of elements that carry properties, in document order
+    stack = []  # one slot per open element inside a process: that tuple, or None without id
+    depth = 0
+    in_process = False
+    for event, el in events:
+        if event == "start":
+            depth += 1
+            if depth == 2:
+                in_process = el.tag == _PROCESS_TAG
+            elif in_process:
+                if el.tag == _CAMUNDA_PROP:
+                    # a property counts for every id-bearing ancestor, as before;
+                    # ancestors sit outermost-first, so recording an element on
+                    # its first property keeps document order
+                    for entry in stack:
+                        if entry is not None:
+                            if not entry[2]:
+                                tagged.append(entry)
+                            entry[2][el.get("name", "")] = el.get("value", "")
+                el_id = el.get("id")
+                if el_id is None:
+                    stack.append(None)
+                    continue
+                # name may be in default ns or explicitly prefixed; cover both
+                el_name = el.get("name") or el.get(_NAME_ATTR_EXPANDED, "")
+                if el_name:
+                    names.append(el_name)
+                stack.append((el_id, el_name, {}))
+        else:
+            if in_process and depth > 2:
+                stack.pop()
+            depth -= 1
+            el.clear()
+            if _HAS_LXML:
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+    rows = [
+        (
+            el_id,
+            el_name,
+            props.get("kpi_key", ""),
+            props.get("kpi_target", ""),
+            props.get("owner", ""),
         )
-        if nm:
-            names.append(nm)
-    # dedupe preserving order
-    seen, out = set(), []
-    for n in names:
-        if n not in seen:
-            out.append(n)
-            seen.add(n)
-    return out
+        for el_id, el_name, props in tagged
+    ]
+    # dedupe names preserving order
+    return pd.DataFrame.from_records(rows, columns=_KPI_COLUMNS), list(dict.fromkeys(names))
+
+# ------------------ VIEWER ------------------
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def viewer_html(xml_digest: str, _bpmn_xml: bytes) -> str:
+    """
+    bpmn-js viewer page for the diagram. Cached on xml_digest like parse_bpmn,
+    which only saves re-running the base64 encode for an unchanged diagram.
+    """
+    # XML travels as base64 in an inert data block: encoding is a single C pass
+    # (no per-character JSON escaping) and needs no </script> escaping either
+    bpmn_b64 = base64.b64encode(_bpmn_xml).decode("ascii")
+    return f"""
+<div id="canvas" style="height:65vh;border:1px solid #ddd;border-radius:8px;"></div>
+<script type="application/octet-stream" id="bpmn-xml">{bpmn_b64}</script>
+<script src="https://unpkg.com/bpmn-js@10.2.1/dist/bpmn-viewer.production.min.js"></script>
+<script>
+  const viewer = new BpmnJS({{ container: '#canvas' }});
+  const b64 = document.getElementById('bpmn-xml').textContent;
+  const xml = new TextDecoder('utf-8').decode(Uint8Array.from(atob(b64), (c) => c.charCodeAt(0)));
+  viewer.importXML(xml).then(() => {{
+    const canvas = viewer.get('canvas');
+    canvas.zoom('fit-viewport');
+  }}).catch((err) => {{
+    const pre = document.createElement('pre'); pre.textContent = (err && err.message) ? err.message : err;
+    document.body.appendChild(pre);
+  }});
+</script>
+"""
 
 # ------------------ SIDEBAR: SOURCE PICKER ------------------
 st.sidebar.header("Diagram Source")
 
-# Folder selector (dynamic from repo root)
-folders = list_folders_at_root()
+# Folder selector (dynamic from repo root; one cached tree call covers all folders)
+try:
+    layout = repo_layout()
+    st.session_state["repo_layout"] = layout
+except Exception as e:
+    # keep browsing on the last good listing if a refresh of it fails
+    layout = st.session_state.get("repo_layout")
+    if layout is None:
+        st.sidebar.error(f"List error: {e}")
+        st.stop()
+    st.sidebar.warning(f"Using last known folder list (refresh failed: {e})")
+
+folders = list(layout)
 if not folders:
     st.sidebar.error("No folders found at repo root.")
     st.stop()
 
 folder = st.sidebar.selectbox("Folder", folders, index=folders.index("hr") if "hr" in folders else 0)
 
-# List .bpmn files in selected folder
-bpmn_files = []
-list_err = None
-try:
-    items = gh_contents(folder)
-    bpmn_files = [it["name"] for it in items if it.get("type") == "file" and it["name"].lower().endswith(".bpmn")]
-except Exception as e:
-    list_err = str(e)
-
-if list_err:
-    st.sidebar.error(f"List error: {list_err}")
-    st.stop()
-
+# .bpmn files in selected folder
+bpmn_files = layout[folder]
 if not bpmn_files:
     st.sidebar.warning("No .bpmn files found in this folder.")
     st.stop()
@@ -185,47 +352,44 @@ KPI_PATH = f"{folder}/{base}_kpis.csv"
 st.sidebar.divider()
 if st.sidebar.button("🔄 Refresh now"):
     st.cache_data.clear()
+    _expire_http_cache()
+    # the sidebar above was built from the cached listing: rerun so newly
+    # committed folders/diagrams show up on this click
+    st.rerun()
 
 # ------------------ LOAD SELECTED FILES ------------------
+# BPMN and KPI CSV are independent: fetch both at once (I/O releases the GIL)
+with ThreadPoolExecutor(max_workers=2) as ex:
+    f_bpmn = ex.submit(load_bytes, raw_url(BPMN_PATH))
+    f_kpis = ex.submit(load_csv_safe, raw_url(KPI_PATH))
+
 try:
-    bpmn_xml = load_text(raw_url(BPMN_PATH))
+    bpmn_xml = f_bpmn.result()
 except Exception as e:
     st.error(f"Failed to load BPMN: {e}")
     st.stop()
+xml_digest = bpmn_digest(bpmn_xml)
 
-csv_url = raw_url(KPI_PATH)
 kpis_df = None
-if head_exists(csv_url):
-    try:
-        kpis_df = load_csv_safe(csv_url)
-    except Exception as e:
+try:
+    # single GET; a 404 just means there is no KPI CSV for this diagram
+    kpis_df = f_kpis.result()
+except requests.HTTPError as e:
+    if e.response is None or e.response.status_code != 404:
         st.warning(f"Found KPI CSV but could not load: {e}")
+except Exception as e:
+    st.warning(f"Found KPI CSV but could not load: {e}")
 
 # ------------------ TITLE ------------------
 st.title("HR Recruitment — BPMN + KPI Monitor")
 
 # ------------------ RENDER DIAGRAM ------------------
 st.subheader("Process Diagram")
-bpmn_html = f"""
-<div id="canvas" style="height:65vh;border:1px solid #ddd;border-radius:8px;"></div>
-<script src="https://unpkg.com/bpmn-js@10.2.1/dist/bpmn-viewer.production.min.js"></script>
-<script>
-  const viewer = new BpmnJS({{ container: '#canvas' }});
-  const xml = {json.dumps(bpmn_xml)};
-  viewer.importXML(xml).then(() => {{
-    const canvas = viewer.get('canvas');
-    canvas.zoom('fit-viewport');
-  }}).catch((err) => {{
-    const pre = document.createElement('pre'); pre.textContent = (err && err.message) ? err.message : err;
-    document.body.appendChild(pre);
-  }});
-</script>
-"""
-st.components.v1.html(bpmn_html, height=520, scrolling=True)
+st.components.v1.html(viewer_html(xml_digest, bpmn_xml), height=520, scrolling=True)
 
 # ------------------ KPI TABLE ------------------
 st.subheader("KPI Mapping")
-map_df = parse_kpi_properties(bpmn_xml)
+map_df, named_tasks = parse_bpmn(xml_digest, bpmn_xml)
 
 if kpis_df is not None:
     st.caption("Loaded from existing CSV in repo.")
@@ -256,7 +420,7 @@ with st.expander("✨ Generate KPIs with AI", expanded=False):
 
     if st.button("Generate KPIs from BPMN"):
         try:
-            tasks = extract_named_tasks(bpmn_xml)
+            tasks = named_tasks
             if not tasks:
                 st.warning("No named tasks found in BPMN.")
             else:
@@ -314,7 +478,6 @@ with st.expander("How this works"):
 # ------------------ AUTO-REFRESH ------------------
 if AUTO_REFRESH_SECONDS:
     st.markdown(f"_Auto-refreshing every **{AUTO_REFRESH_SECONDS}s** (change in the sidebar to disable)._")
-    # Sleep at the very end, then rerun
-    time.sleep(AUTO_REFRESH_SECONDS)
-    st.rerun()
+    # Browser-side timer triggers the rerun, so no server thread sits in sleep()
+    st_autorefresh(interval=AUTO_REFRESH_SECONDS * 1000, key="auto_refresh")
 